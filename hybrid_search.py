@@ -1,4 +1,6 @@
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import streamlit as st
 import os
 import google.generativeai as genai
@@ -10,15 +12,70 @@ import couchbase.search as search
 from couchbase.options import SearchOptions
 from couchbase.vector_search import VectorQuery, VectorSearch
 
+# Must match the dims of the vector field in the search index
+EMBEDDING_DIMENSIONS = 256
 
-def generate_embeddings(input_data):
+# Maximum number of concurrent translation requests
+TRANSLATION_CONCURRENCY = 5
+
+# Stored fields displayed for each result
+RESULT_FIELDS = [
+    "Series_Title",
+    "Poster_Link",
+    "Overview",
+    "Overview_ko",
+    "Released_Year",
+    "IMDB_Rating",
+    "Runtime",
+]
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def generate_embeddings(model, output_dimensionality, input_data):
     """Google Generative AI를 사용하여 입력 데이터의 임베딩을 생성합니다"""
     result = genai.embed_content(
-        model=EMBEDDING_MODEL,
+        model=model,
         content=input_data,
         task_type="retrieval_query",
+        output_dimensionality=output_dimensionality,
     )
-    return result['embedding']
+
+    # Rescale the reduced dimension embedding to unit length for dot_product
+    embedding = np.asarray(result['embedding'], dtype=np.float32)
+    return (embedding / np.linalg.norm(embedding)).tolist()
+
+
+@st.cache_resource
+def get_flash_model():
+    """번역에 사용할 Gemini 모델을 생성합니다"""
+    return genai.GenerativeModel("gemini-1.5-flash")
+
+
+def translate_to_korean(texts: List[str]) -> List[Optional[str]]:
+    """Gemini를 사용하여 여러 텍스트를 동시에 한국어로 번역합니다"""
+    model = get_flash_model()
+
+    def translate(text):
+        try:
+            response = model.generate_content(
+                f"Translate the following text to Korean. Only return the translated text without any additional comments: {text}",
+                generation_config=genai.types.GenerationConfig(
+                    candidate_count=1,
+                    max_output_tokens=100,
+                    temperature=0.2,
+                ),
+            )
+            return response.text.strip()
+        except Exception as e:
+            print(f"Error translating text: {e}")
+            return None
+
+    # The sync client is used from a thread pool because an async client would
+    # stay bound to the event loop of the first Streamlit run
+    with ThreadPoolExecutor(
+        max_workers=min(len(texts), TRANSLATION_CONCURRENCY)
+    ) as executor:
+        return list(executor.map(translate, texts))
 
 
 @st.cache_resource(show_spinner="Connecting to Couchbase")
@@ -36,7 +93,7 @@ def connect_to_couchbase(connection_string, db_username, db_password):
     return cluster
 
 
-@st.cache_resource
+@st.cache_data
 def create_filter(
     year_range: Tuple[int], rating: float, search_in_title: bool, title: str
 ) -> Dict[str, Any]:
@@ -82,26 +139,30 @@ def search_couchbase(
     embedding_key: str,
     search_text: str,
     k: int = 5,
+    num_candidates: int = 40,
     fields: List[str] = ["*"],
     search_options: Dict[str, Any] = {},
 ):
-    """Hybrid search using Python SDK in couchbase"""
+    """Hybrid search using Python SDK in couchbase, yielding (fields, score) per hit"""
     # Generate vector embeddings to search with
-    search_embedding = generate_embeddings(search_text)
+    # The model and dimensions are arguments so that they are part of the cache key
+    search_embedding = generate_embeddings(
+        EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, search_text
+    )
 
-    # Create the search request
+    # Create the search request. The vector index considers at least
+    # num_candidates neighbours, trading latency for recall, while only the
+    # top k hits are returned
     search_req = search.SearchRequest.create(
         VectorSearch.from_vector_query(
             VectorQuery(
                 embedding_key,
                 search_embedding,
-                k,
+                max(k, num_candidates),
             )
         )
     )
 
-    docs_with_score = []
-
     try:
         # Perform the search
         search_iter = db_scope.search(
@@ -114,15 +175,12 @@ def search_couchbase(
             ),
         )
 
-        # Parse the results
+        # Yield the results as they are streamed from the server
         for row in search_iter.rows():
-            score = row.score
-            docs_with_score.append((row.fields, score))
+            yield row.fields, row.score
     except Exception as e:
         raise e
 
-    return docs_with_score
-
 
 if __name__ == "__main__":
     st.set_page_config(
@@ -143,9 +201,6 @@ if __name__ == "__main__":
     INDEX_NAME = os.getenv("INDEX_NAME")
     EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
 
-    # Initialize empty filters
-    search_filters = {}
-
     # Google Generative AI 설정
     genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
@@ -176,32 +231,22 @@ if __name__ == "__main__":
 
     if text:
         with st.spinner("Searching..."):
-            # Translate the search text to English if it's in Korean
-            model = genai.GenerativeModel("gemini-1.5-flash")
-            response = model.generate_content(
-                f"Translate the following text to English. Only return the translated text without any additional comments: {text}",
-                generation_config=genai.types.GenerationConfig(
-                    candidate_count=1,
-                    max_output_tokens=100,
-                    temperature=0.2,
-                ),
-            )
-            search_text = response.text.strip()
-            st.write(f"Translated text: {search_text}")
-
-            # Fetch the filters
-            search_filters = create_filter(year_range, rating, search_in_title, text)
-
-            # Search using the Couchbase Python SDK
+            # Search using the Couchbase Python SDK. text-embedding-004 is
+            # multilingual, so the query is embedded without translating it
             results = search_couchbase(
                 scope,
                 INDEX_NAME,
                 "Overview_embedding",
-                search_text,
+                text,
                 k=no_of_results,
-                search_options=search_filters,
+                fields=RESULT_FIELDS,
+                search_options=hybrid_search_filter,
             )
 
+            # Placeholders for the translations that are not stored in the index
+            pending_translations = []
+
+            # Render each result as soon as it arrives from the server
             for doc in results:
                 movie, score = doc
 
@@ -213,23 +258,26 @@ if __name__ == "__main__":
                 with col2:
                     st.write(movie["Overview"])
 
-                    # Translate the movies text to Korean
-                    try:
-                        model = genai.GenerativeModel("gemini-1.5-flash")
-                        response = model.generate_content(
-                            f"Translate the following text to Korean. Only return the translated text without any additional comments: {movie['Overview']}",
-                            generation_config=genai.types.GenerationConfig(
-                                candidate_count=1,
-                                max_output_tokens=100,
-                                temperature=0.2,
-                            ),
-                        )
-                        st.write(response.text.strip())
-                    except Exception as e:
-                        print(f"Error translating text: {e}")
+                    # Korean translation is precomputed during ingestion when available
+                    if movie.get("Overview_ko"):
+                        st.write(movie["Overview_ko"])
+                    else:
+                        pending_translations.append((movie, st.empty()))
 
                     st.write(f"Score: {score:.{3}f}")
                     st.write("Released Year:", movie["Released_Year"])
                     st.write("IMDB Rating:", movie["IMDB_Rating"])
                     st.write("Runtime:", movie["Runtime"])
                 st.divider()
+
+            # Translate the remaining overviews in one concurrent batch once
+            # all the results are already on screen
+            if pending_translations:
+                translations = translate_to_korean(
+                    [movie["Overview"] for movie, _ in pending_translations]
+                )
+                for (_, placeholder), translation in zip(
+                    pending_translations, translations
+                ):
+                    if translation:
+                        placeholder.write(translation)
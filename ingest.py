@@ -5,9 +5,15 @@ from couchbase.auth import PasswordAuthenticator
 from couchbase.options import ClusterOptions
 from datetime import timedelta
 from tqdm import tqdm
-import uuid
+from tqdm.asyncio import tqdm_asyncio
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import islice
+import numpy as np
 import pandas as pd
 import google.generativeai as genai
+from google.generativeai.client import get_default_generative_async_client
 
 load_dotenv()
 
@@ -22,6 +28,13 @@ DB_SCOPE = os.getenv("DB_SCOPE")
 DB_COLLECTION = os.getenv("DB_COLLECTION")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
 MOVIES_DATASET = "imdb_top_1000.csv"
+EMBEDDING_DIMENSIONS = 256
+EMBEDDING_BATCH_SIZE = 100
+EMBEDDING_CONCURRENCY = 5
+TRANSLATION_CONCURRENCY = 5
+TRANSLATION_MAX_OUTPUT_TOKENS = 1024
+UPSERT_WORKERS = 16
+UPSERT_BATCH_SIZE = 100
 
 def connect_to_couchbase(connection_string, db_username, db_password):
     """Connect to couchbase"""
@@ -37,23 +50,120 @@ def connect_to_couchbase(connection_string, db_username, db_password):
     return cluster
 
 
-def generate_embeddings(title, input_data):
-    """Google Generative AI를 사용하여 입력 데이터의 임베딩을 생성합니다"""
-    result = genai.embed_content(
-        model=EMBEDDING_MODEL,
-        content=input_data,
-        task_type="retrieval_document",
-        title=title,
-    )
-    return result['embedding']
-
-def cleanup_poster_url(poster_url):
+async def embed_batch(semaphore, titles, overviews):
+    """하나의 배치에 대한 임베딩을 생성합니다"""
+    # The client is called directly so that each overview keeps its own title
+    requests = [
+        genai.protos.EmbedContentRequest(
+            model=EMBEDDING_MODEL,
+            content=genai.protos.Content(parts=[genai.protos.Part(text=overview)]),
+            task_type=genai.protos.TaskType.RETRIEVAL_DOCUMENT,
+            title=title,
+            output_dimensionality=EMBEDDING_DIMENSIONS,
+        )
+        for title, overview in zip(titles, overviews)
+    ]
+    async with semaphore:
+        response = await get_default_generative_async_client().batch_embed_contents(
+            genai.protos.BatchEmbedContentsRequest(
+                model=EMBEDDING_MODEL, requests=requests
+            )
+        )
+    return [list(embedding.values) for embedding in response.embeddings]
+
+
+async def generate_embeddings(titles, overviews):
+    """Google Generative AI를 사용하여 입력 데이터 목록의 임베딩을 배치 단위로 동시에 생성합니다"""
+    # Limit the number of in-flight requests to stay within the API rate limits
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    tasks = [
+        embed_batch(
+            semaphore,
+            titles[i : i + EMBEDDING_BATCH_SIZE],
+            overviews[i : i + EMBEDDING_BATCH_SIZE],
+        )
+        for i in range(0, len(overviews), EMBEDDING_BATCH_SIZE)
+    ]
+
+    # gather preserves the order of the batches
+    results = await tqdm_asyncio.gather(*tasks)
+    return [embedding for result in results for embedding in result]
+
+
+async def translate_overview(semaphore, model, input_data):
+    """영화 개요를 한국어로 번역합니다"""
+    async with semaphore:
+        try:
+            response = await model.generate_content_async(
+                f"Translate the following text to Korean. Only return the translated text without any additional comments: {input_data}",
+                generation_config=genai.types.GenerationConfig(
+                    candidate_count=1,
+                    max_output_tokens=TRANSLATION_MAX_OUTPUT_TOKENS,
+                    temperature=0.2,
+                ),
+            )
+
+            # A truncated translation would be stored permanently, so treat it
+            # as a failure
+            finish_reason = response.candidates[0].finish_reason
+            if finish_reason == genai.protos.Candidate.FinishReason.MAX_TOKENS:
+                print(f"Translation truncated at the token limit: {input_data}")
+                return None
+
+            return response.text.strip()
+        except Exception as e:
+            print(f"Error translating text: {e}")
+            return None
+
+
+async def generate_translations(input_data):
+    """Gemini를 사용하여 입력 데이터 목록을 한국어로 동시에 번역합니다"""
+    model = genai.GenerativeModel("gemini-1.5-flash")
+    semaphore = asyncio.Semaphore(TRANSLATION_CONCURRENCY)
+    tasks = [translate_overview(semaphore, model, text) for text in input_data]
+    return await tqdm_asyncio.gather(*tasks)
+
+
+async def main(titles, overviews):
+    """임베딩 생성과 번역을 하나의 이벤트 루프에서 실행합니다"""
+    # genai caches its async client per process and binds it to the loop it
+    # was created in, so both phases have to share a single asyncio.run
+    print("Generating Embeddings...")
+    embeddings = await generate_embeddings(titles, overviews)
+
+    print("Translating Overviews...")
+    translations = await generate_translations(overviews)
+
+    return embeddings, translations
+
+
+def cleanup_poster_urls(poster_urls):
     """Convert from https://m.media-amazon.com/images/M/MV5BMDFkYTc0MGEtZmNhMC00ZDIzLWFmNTEtODM1ZmRlYWMwMWFmXkEyXkFqcGdeQXVyMTMxODk2OTU@._V1_UX67_CR0,0,67,98_AL_.jpg to https://m.media-amazon.com/images/M/MV5BMDFkYTc0MGEtZmNhMC00ZDIzLWFmNTEtODM1ZmRlYWMwMWFmXkEyXkFqcGdeQXVyMTMxODk2OTU@._V1_.jpg"""
 
-    prefix = poster_url.split("_V1_")[0]
-    suffix = poster_url.split("_AL_")[1]
+    # Strip the resizing parameters for all the posters in one pass
+    parts = poster_urls.str.extract(r"^(.*?)_V1_.*_AL_(.*)$")
+    if parts.isna().any().any():
+        unmatched = poster_urls[parts.isna().any(axis=1)].tolist()
+        raise ValueError(f"Unexpected poster URL format: {unmatched}")
+
+    return parts[0] + parts[1]
+
+
+def generate_document_id(row):
+    """Derive a stable document id so that re-ingesting overwrites the movie"""
+    key = f"{row['Series_Title']}|{row['Released_Year']}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
 
-    return prefix + suffix
+def generate_documents(data, embeddings, translations):
+    """Build the documents to ingest lazily from the rows of the dataframe"""
+    columns = list(data.columns)
+    for i, values in enumerate(data.itertuples(index=False, name=None)):
+        row = dict(zip(columns, values))
+        row["Overview_embedding"] = embeddings[i]
+        if translations[i] is not None:
+            row["Overview_ko"] = translations[i]
+        yield row
 
 
 try:
@@ -70,14 +180,40 @@ try:
     data["Gross"] = data["Gross"].fillna(0)
     data["Certificate"] = data["Certificate"].fillna("NA")
     data["Meta_score"] = data["Meta_score"].fillna(-1)
-    data["Poster_Link"] = data["Poster_Link"].apply(cleanup_poster_url)
+    data["Poster_Link"] = cleanup_poster_urls(data["Poster_Link"])
 
-    data_in_dict = data.to_dict(orient="records")
+    embeddings, translations = asyncio.run(
+        main(data["Series_Title"].tolist(), data["Overview"].tolist())
+    )
+
+    # Normalize all the embeddings to float32 in a single bulk conversion.
+    # Reduced dimension embeddings are rescaled to unit length for dot_product.
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings.tolist()
+
+    failed_translations = sum(translation is None for translation in translations)
+    if failed_translations:
+        print(
+            f"{failed_translations} of {len(translations)} overviews could not be "
+            "translated and are stored without Overview_ko"
+        )
+
+    documents = generate_documents(data, embeddings, translations)
     print("Ingesting Data...")
-    for row in tqdm(data_in_dict):
-        row["Overview_embedding"] = generate_embeddings(row["Series_Title"], row["Overview"])
-        doc_id = uuid.uuid4().hex
-        collection.upsert(doc_id, row)
+
+    # Pipeline the upserts as ingestion is bound by the network round-trips.
+    # executor.map submits everything it is given up front, so documents are
+    # handed over in bounded batches to keep only a batch of them in memory.
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as executor, tqdm(
+        total=len(data)
+    ) as progress:
+        while batch := list(islice(documents, UPSERT_BATCH_SIZE)):
+            for _ in executor.map(
+                lambda row: collection.upsert(generate_document_id(row), row),
+                batch,
+            ):
+                progress.update()
 
 except Exception as e:
     print("Error while ingesting data", e)